@@ -1,13 +1,12 @@
 import streamlit as st
 import pandas as pd
-import base64
 import re
-import time 
 import os
+import functools
 from pathlib import Path
-from email.message import EmailMessage
 from datetime import datetime
-import pytz
+from itertools import zip_longest
+from zoneinfo import ZoneInfo
 
 # Google Cloud & Auth Libraries
 from google.auth.transport.requests import Request
@@ -15,6 +14,19 @@ from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from mailer import (
+    GMAIL_BATCH_SIZE,
+    SEND_REQUESTS_PER_SECOND,
+    build_message,
+    compile_template,
+    execute_batched,
+    fetch_message_ids,
+    new_message_id,
+    reply_subject,
+    retry_execute,
+    template_fields,
+)
+
 # All four scopes are required for the app's full functionality now
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.send", 
@@ -23,7 +35,11 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify" # Required to add labels
 ]
 
+# Spreadsheet ID in a Google Sheets URL (.../spreadsheets/d/<id>/edit)
+_SHEET_ID_RE = re.compile(r'/d/([a-zA-Z0-9_-]+)')
+
 # --- TEMPLATE MANAGEMENT FUNCTIONS ---
+@st.cache_data(ttl=30, show_spinner=False)  # Both tabs list templates on every rerun
 def get_available_templates():
     """Get list of available HTML templates from the templates folder."""
     templates_dir = Path("templates")
@@ -34,11 +50,16 @@ def get_available_templates():
     template_files = list(templates_dir.glob("*.html"))
     return [f.stem for f in template_files]
 
+@functools.lru_cache(maxsize=64)
+def _read_template(template_path, mtime_ns):
+    # Keyed on the modification time, so an edited or re-saved file is read again.
+    return template_path.read_text(encoding='utf-8')
+
 def load_template(template_name):
     """Load HTML template content from file."""
     template_path = Path("templates") / f"{template_name}.html"
     if template_path.exists():
-        return template_path.read_text(encoding='utf-8')
+        return _read_template(template_path, template_path.stat().st_mtime_ns)
     return None
 
 def save_template(template_name, html_content):
@@ -47,6 +68,7 @@ def save_template(template_name, html_content):
     templates_dir.mkdir(exist_ok=True)
     template_path = templates_dir / f"{template_name}.html"
     template_path.write_text(html_content, encoding='utf-8')
+    get_available_templates.clear()  # Show the new template right away
 
 def template_selector_ui(template_type="initial"):
     """Create UI for template selection with option to use saved or upload new."""
@@ -134,8 +156,10 @@ def get_preauthorized_services():
             },
             scopes=SCOPES
         )
-        gmail_service = build("gmail", "v1", credentials=creds)
-        sheets_service = build("sheets", "v4", credentials=creds)
+        # Use the discovery documents bundled with googleapiclient: no HTTP fetch on
+        # cold start and no file-cache lookups (or warnings) on every build.
+        gmail_service = build("gmail", "v1", credentials=creds, static_discovery=True, cache_discovery=False)
+        sheets_service = build("sheets", "v4", credentials=creds, static_discovery=True, cache_discovery=False)
         st.success("Successfully authenticated with Google services.")
         return gmail_service, sheets_service
     except Exception as e:
@@ -148,7 +172,7 @@ def get_preauthorized_services():
 def get_gmail_labels(_gmail_service):
     """Fetches all user-created labels from Gmail."""
     try:
-        results = _gmail_service.users().labels().list(userId='me').execute()
+        results = retry_execute(_gmail_service.users().labels().list(userId='me'))
         labels = results.get('labels', [])
         user_labels = {label['name']: label['id'] for label in labels if label['type'] == 'user'}
         return user_labels
@@ -156,98 +180,138 @@ def get_gmail_labels(_gmail_service):
         st.error(f"Could not fetch Gmail labels: {e}")
         return {}
 
+@st.cache_data(ttl=600, show_spinner=False)
+def get_sender_address(_gmail_service):
+    """Returns the authenticated account's email address. Failures raise, so they are never cached."""
+    return retry_execute(_gmail_service.users().getProfile(userId='me'))['emailAddress']
+
 # --- DATA & HELPER FUNCTIONS ---
+# Timestamps written to the log columns are in IST.
+LOG_TIMEZONE = ZoneInfo("Asia/Kolkata")
+
+def log_timestamp():
+    """Returns the current time as written to the log's Timestamp column."""
+    return datetime.now(LOG_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+
+# Streamlit reruns the whole script on every widget interaction, so sheet reads are
+# cached briefly. Failures raise instead of returning, so they are never cached.
+@st.cache_data(ttl=60, show_spinner=False)
+def get_sheet_grids(_sheets_service, spreadsheet_id):
+    """Returns {sheet title: gridProperties} for every sheet, in workbook order."""
+    sheet_metadata = retry_execute(_sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields='sheets.properties(title,gridProperties(rowCount,columnCount))'
+    ))
+    return {s['properties']['title']: s['properties'].get('gridProperties', {}) for s in sheet_metadata['sheets']}
+
+def get_sheet_names(sheets_service, spreadsheet_id):
+    """Returns the titles of all sheets in the workbook."""
+    return list(get_sheet_grids(sheets_service, spreadsheet_id))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def read_sheet(_sheets_service, spreadsheet_id, sheet_name=None):
+    """Reads a sheet (the first one by default) into a DataFrame."""
+    grids = get_sheet_grids(_sheets_service, spreadsheet_id)
+    if sheet_name is None:
+        sheet_name = next(iter(grids))
+
+    # Bound the read by the sheet's grid instead of a fixed A:Z, which both requested
+    # columns that do not exist and silently dropped any past Z.
+    grid = grids.get(sheet_name, {})
+    cell_range = f"A1:{column_letter(grid.get('columnCount', 26) - 1)}{grid.get('rowCount', '')}"
+    result = retry_execute(_sheets_service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id, range=f"{sheet_name}!{cell_range}", majorDimension='ROWS',
+        fields='values'  # The echoed range and majorDimension are never used
+    ))
+    values = result.get('values', [])
+
+    if not values: return pd.DataFrame(), [], sheet_name
+
+    headers = values[0]
+    data = values[1:]
+    # Sheets drops trailing empty cells, so rows are ragged. Transpose with padding and
+    # build each column directly instead of letting pandas reshape row by row.
+    columns = list(zip_longest(*data, fillvalue=''))[:len(headers)]
+    columns += [('',) * len(data)] * (len(headers) - len(columns))
+    df = pd.DataFrame(dict(enumerate(columns)), index=range(len(data)))
+    df.columns = headers
+    return df, headers, sheet_name
+
 def get_sheet_data(sheets_service, spreadsheet_id, sheet_name=None):
     try:
-        if sheet_name is None:
-            sheet_metadata = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-            sheets = sheet_metadata.get('sheets', '')
-            sheet_name = sheets[0].get("properties", {}).get("title", "Sheet1")
-        
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id, range=f"{sheet_name}!A:Z"
-        ).execute()
-        values = result.get('values', [])
-        
-        if not values: return pd.DataFrame(), [], sheet_name
-        
-        headers = values[0]
-        data = values[1:]
-        df = pd.DataFrame(data, columns=headers)
-        return df, headers, sheet_name
+        return read_sheet(sheets_service, spreadsheet_id, sheet_name)
     except Exception as e:
         st.error(f"Failed to read Google Sheet '{sheet_name}'. Check link/permissions. Error: {e}")
         return pd.DataFrame(), [], ""
 
-# --- EMAIL SENDING FUNCTIONS (UPDATED) ---
-def send_initial_email(service, to_email, subject, html_body_template, row_data):
-    """Creates and sends a new email, returns the sent message object."""
-    try:
-        final_html_body = html_body_template.format(**row_data)
-        final_subject = subject.format(**row_data)
-        message = EmailMessage()
-        message.add_alternative(final_html_body, subtype='html')
-        message["To"] = to_email
-        message["From"] = "me"
-        message["Subject"] = final_subject
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        create_message = {"raw": encoded_message}
-        sent_message = service.users().messages().send(userId="me", body=create_message).execute()
-        return sent_message 
-    except Exception as e:
-        st.error(f"An error occurred sending initial email to {to_email}: {e}")
-        return None
+# Refresh progress widgets every N rows instead of emitting one element per row.
+PROGRESS_EVERY = 50
+# Write the log of sent rows to the sheet every N sends, so an interrupted run keeps its log.
+LOG_FLUSH_EVERY = 100
+LOG_HEADERS = ["Timestamp", "Status", "Subject", "Thread ID", "Message ID"]
+
+def show_failures(failures, what):
+    """Renders collected (row, email, error) failures once, as a single table."""
+    if failures:
+        st.error(f"{len(failures)} {what} failed:")
+        st.dataframe(pd.DataFrame(failures, columns=["Row", "Email", "Error"]), hide_index=True)
+
+@functools.lru_cache(maxsize=None)
+def column_letter(index):
+    """Converts a 0-based column index to its A1 letter (0 -> A, 26 -> AA)."""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def build_log_updates(sheet_name, columns, update_log, log_headers, new_headers):
+    """Builds values.batchUpdate data that only touches the log cells of updated rows.
+
+    Header cells are written only for new_headers. Log columns that sit next to each
+    other in the sheet are written as one range per row.
+    """
+    positions = {header: columns.index(header) for header in log_headers}
+    data = [{"range": f"{sheet_name}!{column_letter(positions[h])}1", "values": [[h]]} for h in new_headers]
+
+    runs = []  # (first column index, headers in that contiguous run)
+    for header in sorted(log_headers, key=positions.get):
+        if runs and runs[-1][0] + len(runs[-1][1]) == positions[header]:
+            runs[-1][1].append(header)
+        else:
+            runs.append((positions[header], [header]))
+
+    for row_index, log_data in update_log.items():
+        sheet_row = row_index + 2  # +1 for the header row, +1 because A1 rows start at 1
+        for start, headers in runs:
+            cell_range = f"{column_letter(start)}{sheet_row}:{column_letter(start + len(headers) - 1)}{sheet_row}"
+            data.append({"range": f"{sheet_name}!{cell_range}", "values": [[log_data[h] for h in headers]]})
+    return data
+
+def write_log(sheets_service, spreadsheet_id, sheet_name, columns, update_log, new_headers):
+    """Writes update_log (row index -> LOG_HEADERS values) to the sheet in one batchUpdate."""
+    update_data = build_log_updates(sheet_name, columns, update_log, LOG_HEADERS, new_headers)
+    retry_execute(sheets_service.spreadsheets().values().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"valueInputOption": "USER_ENTERED", "data": update_data}
+    ))
+
+# messages.batchModify accepts at most 1000 message ids per call.
+BATCH_MODIFY_LIMIT = 1000
 
-def apply_label_to_message(service, msg_id, label_ids_to_add):
-    """Applies a list of labels to a specific message."""
+def apply_labels_to_messages(service, msg_ids, label_ids_to_add):
+    """Applies a list of labels to many messages with batchModify calls."""
     try:
-        modify_request = {'addLabelIds': label_ids_to_add, 'removeLabelIds': []}
-        service.users().messages().modify(userId='me', id=msg_id, body=modify_request).execute()
+        for start in range(0, len(msg_ids), BATCH_MODIFY_LIMIT):
+            modify_request = {'ids': msg_ids[start:start + BATCH_MODIFY_LIMIT], 'addLabelIds': label_ids_to_add, 'removeLabelIds': []}
+            retry_execute(service.users().messages().batchModify(userId='me', body=modify_request))
         return True
     except Exception as e:
-        st.warning(f"Could not apply label to message {msg_id}. Error: {e}")
+        st.warning(f"Could not apply label to {len(msg_ids)} messages. Error: {e}")
         return False
 
 
-def get_message_id_with_retry(service, gmail_message_id):
-    """Retrieves Message-ID header with exponential backoff retry logic."""
-    for attempt in range(5):
-        try:
-            full_message = service.users().messages().get(userId='me', id=gmail_message_id, format='full').execute()
-            message_id = next((h['value'] for h in full_message['payload']['headers'] if h['name'].lower() == 'message-id'), None)
-            if message_id:
-                st.write(f"&nbsp;&nbsp;&nbsp;↳ Success: Found Message-ID: `{message_id}`")
-                return message_id
-        except Exception:
-            time.sleep(2 ** attempt)
-    st.warning("&nbsp;&nbsp;&nbsp;↳ Warning: Could not retrieve Message-ID after all retries")
-    return ""
-
-def send_reply_email(service, to_email, subject, thread_id, original_msg_id, html_body_template, row_data, label_ids=[]):
-    """Sends a reply and applies labels."""
-    try:
-        final_html_body = html_body_template.format(**row_data)
-        final_subject = f"Re: {subject}" if not subject.lower().startswith("re:") else subject
-        message = EmailMessage()
-        message.add_alternative(final_html_body, subtype='html')
-        message["To"] = to_email
-        message["From"] = "me"
-        message["Subject"] = final_subject
-        message["In-Reply-To"] = original_msg_id
-        message["References"] = original_msg_id
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        create_message = {"raw": encoded_message, "threadId": thread_id}
-        sent_message = service.users().messages().send(userId="me", body=create_message).execute()
-        
-        # Apply labels to the reply if any are selected
-        if sent_message and label_ids:
-            apply_label_to_message(service, sent_message['id'], label_ids)
-            
-        return sent_message
-    except Exception as e:
-        st.error(f"An error occurred sending reply to {to_email}: {e}")
-        return None
-
 # --- MAIN STREAMLIT UI ---
 st.set_page_config(layout="wide")
 st.title("CR Mailing Scenes")
@@ -260,17 +324,23 @@ if gmail_service and sheets_service:
     sheet_url = st.text_input("Make sure all the columns are filled!")
 
     if sheet_url:
+        sheet_id_match = _SHEET_ID_RE.search(sheet_url)
+        if not sheet_id_match:
+            st.error("Invalid Google Sheet URL."); st.stop()
+        spreadsheet_id = sheet_id_match.group(1)
         try:
-            spreadsheet_id = re.search('/d/([a-zA-Z0-9-_]+)', sheet_url).group(1)
-            sheet_names = [s['properties']['title'] for s in sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()['sheets']]
+            sheet_names = get_sheet_names(sheets_service, spreadsheet_id)
             
             if sheet_names:
                 selected_sheet = st.selectbox("Select which sheet to load:", options=sheet_names, key="sheet_selector")
+                if st.button("Refresh sheet"):
+                    get_sheet_grids.clear()
+                    read_sheet.clear()
                 df, headers, sheet_name = get_sheet_data(sheets_service, spreadsheet_id, selected_sheet)
             else:
                 st.error("No sheets found in the workbook."); st.stop()
-        except:
-            st.error("Invalid Google Sheet URL."); st.stop()
+        except Exception as e:
+            st.error(f"Could not open the Google Sheet. Check the link and sharing permissions. Error: {e}"); st.stop()
 
         if not df.empty:
             st.success(f"Successfully loaded {len(df)} rows from sheet: '{sheet_name}'")
@@ -288,6 +358,18 @@ if gmail_service and sheets_service:
                     key="initial_label"
                 )
                 label_id_to_apply = [gmail_labels[selected_label_name]] if selected_label_name else []
+                skip_already_sent = st.checkbox(
+                    "Skip rows already marked as Sent",
+                    value=True,
+                    key="initial_skip_sent",
+                    help="Rows whose Status column says 'Sent' were logged by an earlier run of this campaign."
+                )
+                use_fast_insert = st.checkbox(
+                    "Fast mode (no actual delivery)",
+                    key="initial_fast_insert",
+                    help="Inserts the emails straight into your Sent folder with messages.insert instead of sending them. "
+                         "Much faster, but nobody receives anything: only use it to log outreach that happened elsewhere."
+                )
                 
                 html_template = template_selector_ui("initial")
                 
@@ -297,8 +379,8 @@ if gmail_service and sheets_service:
                         st.info("This preview uses data from the first row of your sheet.")
                         try:
                             first_row_data = df.iloc[0].to_dict()
-                            preview_subject = subject_input.format(**first_row_data)
-                            preview_html = html_template.format(**first_row_data)
+                            preview_subject = subject_input.format_map(first_row_data)
+                            preview_html = html_template.format_map(first_row_data)
                             
                             st.text_input("Rendered Subject:", preview_subject, disabled=True)
                             st.markdown("---")
@@ -318,42 +400,139 @@ if gmail_service and sheets_service:
                         
                         with st.expander("Live Send Status", expanded=True):
                             st.write("--- Phase 1: Sending Emails ---")
-                            for i, row in df.iterrows():
-                                if pd.isna(row.get('email')) or not row.get('email'): continue
-                                st.write(f"Row {i+2}: Sending to **{row.get('email')}**...")
-                                result = send_initial_email(gmail_service, row.get('email'), subject_input, html_template, row.to_dict())
-                                if result:
-                                    temp_id = result['id']
-                                    if label_id_to_apply:
-                                        apply_label_to_message(gmail_service, temp_id, label_id_to_apply)
-                                        st.write(f"&nbsp;&nbsp;&nbsp;↳ Label '{selected_label_name}' applied.")
-                                    sent_emails_info.append({"row_index": i, "temp_id": temp_id, "thread_id": result['threadId'], "subject": subject_input.format(**row.to_dict())})
-                                    st.write(f"&nbsp;&nbsp;&nbsp;↳ Success: Email sent.")
+                            try:
+                                render_subject = compile_template(subject_input)
+                                render_body = compile_template(html_template)
+                            except ValueError as e:
+                                st.error(f"Template error in subject or body: {e}"); st.stop()
+                            missing_columns = (template_fields(subject_input) | template_fields(html_template)) - set(df.columns)
+                            if missing_columns:
+                                st.error(f"⚠️ Placeholder Error: {', '.join(sorted(missing_columns))} in your template or subject does not match any column in your sheet."); st.stop()
+                            sender_address = None
+                            if use_fast_insert:
+                                # Inserted messages are stored exactly as built, so give them a Message-ID
+                                # on the sender's domain. Gmail sets its own on messages it sends.
+                                try:
+                                    sender_address = get_sender_address(gmail_service)
+                                except Exception as e:
+                                    st.warning(f"Could not fetch the sender address, so inserted emails get no Message-ID. Error: {e}")
+                            pending = {}
+                            send_requests = []
+                            failures = []
+                            if 'email' in df.columns:
+                                emails = df['email'].fillna('').astype(str).str.strip()
+                                has_email = emails.ne('')
+                                valid_email = has_email & emails.str.contains('@', regex=False)
+                                failures += [(i + 2, email, "Not a valid email address") for i, email in emails[has_email & ~valid_email].items()]
+                                if skip_already_sent and 'Status' in df.columns:
+                                    already_sent = df['Status'].eq('Sent')
+                                    if already_sent.any():
+                                        st.write(f"Skipping {int((valid_email & already_sent).sum())} rows already marked as Sent.")
+                                    valid_email &= ~already_sent
+                                recipients = df.loc[valid_email]
+                            else:
+                                recipients = df.iloc[0:0]
+                            for i, row_data in zip(recipients.index, recipients.to_dict(orient='records')):
+                                email = row_data['email']
+                                try:
+                                    final_subject = render_subject(row_data)
+                                    message_id = new_message_id(sender_address) if sender_address else None
+                                    body = build_message(email, final_subject, render_body(row_data), message_id=message_id)
+                                except Exception as e:
+                                    failures.append((i + 2, email, f"Could not prepare email: {e}"))
+                                    continue
+                                pending[i] = {"email": email, "subject": final_subject}
+                                if use_fast_insert:
+                                    body["labelIds"] = ["SENT"]
+                                    request = gmail_service.users().messages().insert(userId="me", body=body, internalDateSource="dateHeader")
                                 else:
-                                    st.error(f"&nbsp;&nbsp;&nbsp;↳ Failed to send email to {row.get('email')}.")
-                        
+                                    request = gmail_service.users().messages().send(userId="me", body=body)
+                                send_requests.append((str(i), request))
+
+                            # Inserted rows were never delivered: a distinct status keeps a later real run
+                            # from skipping them as Sent.
+                            log_status = "Inserted" if use_fast_insert else "Sent"
+                            new_headers = [header for header in LOG_HEADERS if header not in df.columns]
+                            log_columns = df.columns.tolist() + new_headers
+                            # Sent rows not yet written to the sheet, and header cells still to create.
+                            unflushed_log = {}
+                            unwritten_headers = list(new_headers)
+                            flush_errors = []
+
+                            def flush_log():
+                                try:
+                                    write_log(sheets_service, spreadsheet_id, sheet_name, log_columns, unflushed_log, unwritten_headers)
+                                except Exception as e:
+                                    # Phase 3 writes the whole log again, so a failed flush only delays it.
+                                    # The rows stay queued and the next try comes LOG_FLUSH_EVERY sends later.
+                                    flush_errors.append(e)
+                                    if len(flush_errors) == 1:
+                                        st.warning(f"Could not log progress to the sheet yet: {e}")
+                                    return
+                                unflushed_log.clear()
+                                unwritten_headers.clear()
+                                read_sheet.clear()  # A rerun after an interruption must see these rows as Sent
+
+                            progress = st.progress(0.0, text=f"Sending {len(send_requests)} emails in batches of up to {GMAIL_BATCH_SIZE}...")
+                            send_failures = []
+
+                            def on_sent(request_id, response, exception):
+                                i = int(request_id)
+                                if exception is not None:
+                                    send_failures.append((i + 2, pending[i]['email'], str(exception)))
+                                else:
+                                    # Stamped as each result comes back, so long runs log when each row was sent.
+                                    sent_at = log_timestamp()
+                                    sent_emails_info.append({"row_index": i, "temp_id": response['id'], "thread_id": response['threadId'], "subject": pending[i]["subject"], "sent_at": sent_at})
+                                    # The Message ID stays blank until Phase 2 confirms what Gmail stored.
+                                    unflushed_log[i] = {"Timestamp": sent_at, "Status": log_status, "Subject": pending[i]["subject"], "Thread ID": response['threadId'], "Message ID": ""}
+                                    if len(unflushed_log) % LOG_FLUSH_EVERY == 0:
+                                        flush_log()
+                                done = len(sent_emails_info) + len(send_failures)
+                                if done % PROGRESS_EVERY == 0 or done == len(send_requests):
+                                    progress.progress(done / len(send_requests), text=f"Sent {done}/{len(send_requests)}")
+
+                            try:
+                                execute_batched(gmail_service, send_requests, on_sent, rate=SEND_REQUESTS_PER_SECOND)
+                            finally:
+                                # Also runs if the send is interrupted (e.g. a rerun), so rows
+                                # already sent are marked Sent and not emailed again next time.
+                                if unflushed_log:
+                                    flush_log()
+                            st.write(f"Sent {len(sent_emails_info)} of {len(send_requests)} emails.")
+                            show_failures(failures + send_failures, "emails")
+
+                            if label_id_to_apply and sent_emails_info:
+                                if apply_labels_to_messages(gmail_service, [item["temp_id"] for item in sent_emails_info], label_id_to_apply):
+                                    st.write(f"&nbsp;&nbsp;&nbsp;↳ Label '{selected_label_name}' applied.")
+
                         update_log = {}
                         if sent_emails_info:
                             with st.expander("Live Log Status", expanded=True):
-                                st.write("\n--- Phase 2: Fetching Message IDs ---")
-                                time.sleep(5)
+                                st.write("\n--- Phase 2: Confirming Message IDs ---")
+                                if use_fast_insert:
+                                    # Nothing was delivered, so there is no Message ID for reminders to reply to.
+                                    message_ids = {}
+                                else:
+                                    message_ids = fetch_message_ids(gmail_service, [item['temp_id'] for item in sent_emails_info])
+                                missing_ids = []
                                 for sent_item in sent_emails_info:
                                     i = sent_item["row_index"]
-                                    msg_id_header = get_message_id_with_retry(gmail_service, sent_item['temp_id'])
-                                    update_log[i] = {"Timestamp": datetime.now(pytz.timezone("Asia/Kolkata")).strftime("%Y-%m-%d %H:%M:%S"), "Status": "Sent", "Subject": sent_item["subject"], "Thread ID": sent_item["thread_id"], "Message ID": msg_id_header}
+                                    # Rows without a confirmed ID are left blank, so reminders skip them.
+                                    msg_id_header = message_ids.get(sent_item['temp_id'], "")
+                                    if not msg_id_header and not use_fast_insert:
+                                        missing_ids.append((i + 2, pending[i]['email'], "Message-ID not available after all retries"))
+                                    update_log[i] = {"Timestamp": sent_item["sent_at"], "Status": log_status, "Subject": sent_item["subject"], "Thread ID": sent_item["thread_id"], "Message ID": msg_id_header}
+                                if use_fast_insert:
+                                    st.write(f"Logged {len(sent_emails_info)} inserted emails as Inserted, without Message IDs.")
+                                else:
+                                    st.write(f"Found Message-IDs for {len(sent_emails_info) - len(missing_ids)} of {len(sent_emails_info)} emails.")
+                                    show_failures(missing_ids, "Message-ID lookups")
 
                         st.info("--- Phase 3: Updating Google Sheet with logs ---")
-                        log_headers = ["Timestamp", "Status", "Subject", "Thread ID", "Message ID"]
-                        for header in log_headers:
-                            if header not in df.columns:
-                                df[header] = ''
-                        for row_index, log_data in update_log.items():
-                            for col_name, value in log_data.items():
-                                df.loc[row_index, col_name] = value
                         try:
-                            update_values = [df.columns.values.tolist()] + df.values.tolist()
-                            sheets_service.spreadsheets().values().clear(spreadsheetId=spreadsheet_id, range=sheet_name).execute()
-                            sheets_service.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range=f"{sheet_name}!A1", valueInputOption="USER_ENTERED", body={'values': update_values}).execute()
+                            write_log(sheets_service, spreadsheet_id, sheet_name, log_columns, update_log, new_headers)
+                            read_sheet.clear()  # The reminder tab needs the new Message IDs on the next rerun
                             st.success("Google Sheet updated successfully!")
                             st.balloons()
                         except Exception as e:
@@ -378,22 +557,50 @@ if gmail_service and sheets_service:
                         if 'Message ID' not in df.columns or 'Thread ID' not in df.columns:
                             st.error("Cannot send reminders. 'Message ID' or 'Thread ID' column not found in the sheet.")
                         else:
-                            reply_df = df[df['Message ID'].notna() & (df['Message ID'] != '')].copy()
+                            message_id_col = df['Message ID']
+                            reply_df = df.loc[message_id_col.notna() & message_id_col.ne('')]
                             if reply_df.empty:
                                 st.warning("No contacts found with a valid 'Message ID' to reply to.")
                             else:
                                 with st.spinner(f"Sending reminders to {len(reply_df)} contacts..."):
-                                    for i, row in reply_df.iterrows():
-                                        send_reply_email(
-                                            gmail_service,
-                                            row.get('email'),
-                                            row.get('Subject'),
-                                            row.get('Thread ID'),
-                                            row.get('Message ID'),
-                                            reminder_template,
-                                            row.to_dict(),
-                                            reply_label_id_to_apply
-                                        )
+                                    try:
+                                        render_reminder = compile_template(reminder_template)
+                                    except ValueError as e:
+                                        st.error(f"Template error in reminder: {e}"); st.stop()
+                                    missing_columns = template_fields(reminder_template) - set(df.columns)
+                                    if missing_columns:
+                                        st.error(f"⚠️ Placeholder Error: {', '.join(sorted(missing_columns))} in your reminder template does not match any column in your sheet."); st.stop()
+                                    reply_emails = {}
+                                    reply_requests = []
+                                    reply_failures = []
+                                    for i, row_data in zip(reply_df.index, reply_df.to_dict(orient='records')):
+                                        try:
+                                            body = build_message(
+                                                row_data.get('email'),
+                                                reply_subject(row_data.get('Subject')),
+                                                render_reminder(row_data),
+                                                thread_id=row_data.get('Thread ID'),
+                                                in_reply_to=row_data.get('Message ID')
+                                            )
+                                        except Exception as e:
+                                            reply_failures.append((i + 2, row_data.get('email'), f"Could not prepare reply: {e}"))
+                                            continue
+                                        reply_emails[i] = row_data.get('email')
+                                        reply_requests.append((str(i), gmail_service.users().messages().send(userId="me", body=body)))
+
+                                    sent_reply_ids = []
+                                    def on_reply_sent(request_id, response, exception):
+                                        if exception is not None:
+                                            reply_failures.append((int(request_id) + 2, reply_emails[int(request_id)], str(exception)))
+                                        else:
+                                            sent_reply_ids.append(response['id'])
+
+                                    execute_batched(gmail_service, reply_requests, on_reply_sent, rate=SEND_REQUESTS_PER_SECOND)
+                                    show_failures(reply_failures, "reminders")
+
+                                    # Apply labels to the replies if any are selected
+                                    if reply_label_id_to_apply and sent_reply_ids:
+                                        apply_labels_to_messages(gmail_service, sent_reply_ids, reply_label_id_to_apply)
                                     st.success("Reminder campaign sent!")
                                     st.balloons()
 else:
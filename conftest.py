@@ -0,0 +1 @@
+# Lets pytest import mailer.py from the repository root.
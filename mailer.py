@@ -0,0 +1,445 @@
+import base64
+import json
+import random
+import string
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.header import Header
+from email.utils import formataddr, formatdate, getaddresses, make_msgid
+
+import httplib2
+import google_auth_httplib2
+from google.auth.transport.requests import Request
+from googleapiclient.errors import HttpError
+
+# Gmail helpers shared by the Streamlit app. Nothing in here touches Streamlit, so
+# every function can be reused from scripts as well as from the UI.
+
+# --- TEMPLATE RENDERING ---
+_FORMATTER = string.Formatter()
+
+def compile_template(template):
+    """Parses a str.format template once and returns a render(row_data) function.
+
+    Rendering matches template.format_map(row_data), including the KeyError for
+    placeholders that are not columns, without re-parsing the template for every row.
+    """
+    parts = list(_FORMATTER.parse(template))
+
+    def render(row_data):
+        pieces = []
+        for literal, field_name, format_spec, conversion in parts:
+            pieces.append(literal)
+            if field_name is None:
+                continue
+            value, _ = _FORMATTER.get_field(field_name, (), row_data)
+            if conversion:
+                value = _FORMATTER.convert_field(value, conversion)
+            if format_spec and "{" in format_spec:
+                format_spec = _FORMATTER.vformat(format_spec, (), row_data)
+            pieces.append(format(value, format_spec))
+        return "".join(pieces)
+
+    return render
+
+def template_fields(template):
+    """Returns the names of the columns a str.format template looks up."""
+    # "{a.b}" and "{a[0]}" both look up column "a".
+    return {
+        field_name.split('.')[0].split('[')[0]
+        for _, field_name, _, _ in _FORMATTER.parse(template)
+        if field_name is not None
+    }
+
+# --- API RETRY HELPERS ---
+# Google APIs answer bursts with 429s and transient 5xx errors; these are safe to retry.
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Gmail reports per-user rate limiting as a 403 with one of these reasons.
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+MAX_TRIES = 6
+
+def _error_reasons(error):
+    """Returns the 'reason' values in a Google API error body."""
+    try:
+        return {detail.get("reason") for detail in json.loads(error.content)["error"]["errors"]}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+
+def is_rate_limited(error):
+    """Returns True for 429s and for 403s Gmail uses to signal rate limiting."""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and bool(_error_reasons(error) & RATE_LIMIT_REASONS))
+
+def is_retryable(error):
+    """Returns True for HttpErrors that are worth retrying."""
+    return is_rate_limited(error) or (isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUSES)
+
+# Connection-level failures (timeouts, resets, DNS) that never got an HTTP answer.
+TRANSPORT_ERRORS = (OSError, httplib2.HttpLib2Error)
+
+def backoff_delay(attempt, error=None):
+    """Seconds to wait before the next try: Retry-After if given, else capped exponential backoff with jitter."""
+    retry_after = error.resp.get('retry-after') if isinstance(error, HttpError) else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return min(32, 2 ** attempt) + random.random()
+
+def retry_execute(request, max_tries=MAX_TRIES, **kwargs):
+    """Executes a googleapiclient request, retrying 429/5xx responses with backoff."""
+    for attempt in range(max_tries):
+        try:
+            return request.execute(**kwargs)
+        except HttpError as e:
+            if not is_retryable(e) or attempt == max_tries - 1:
+                raise
+            time.sleep(backoff_delay(attempt, e))
+
+# Refresh access tokens this long before they expire, so no run pays for it mid-way.
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+def refresh_if_expiring(credentials, margin=TOKEN_REFRESH_MARGIN):
+    """Refreshes OAuth credentials that have no token yet or expire within `margin`."""
+    # google-auth keeps expiry as a naive UTC datetime.
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if credentials.token is None or credentials.expiry is None or credentials.expiry - margin <= now:
+        credentials.refresh(Request())
+
+# --- MESSAGE BUILDING & BATCHED EXECUTION ---
+# Gmail accepts up to 100 calls per batch request but recommends staying at 50 or below.
+GMAIL_BATCH_SIZE = 50
+# Batch-level answers meaning the batch endpoint itself is unavailable, so the calls
+# are worth making one by one.
+BATCH_UNAVAILABLE_STATUSES = {400, 404, 410, 501}
+# Bounds for shrinking and regrowing the batch size when Gmail starts rate limiting.
+MIN_BATCH_SIZE = 5
+BATCH_SIZE_STEP = 5
+
+# Every email is a single text/html part. The body is base64-encoded, so long
+# minified HTML lines never break the 998-character line limit.
+_HTML_PART_HEADERS = (
+    b"MIME-Version: 1.0\r\n"
+    b"Content-Type: text/html; charset=\"utf-8\"\r\n"
+    b"Content-Transfer-Encoding: base64\r\n"
+)
+
+def encode_message(raw):
+    """Encodes raw RFC 5322 message bytes into the base64url string Gmail expects in 'raw'."""
+    # base64 output is pure ASCII, so skip the UTF-8 codec's validation on decode.
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def header_value(value):
+    """Returns a header value on one line, RFC 2047-encoded if it isn't ASCII."""
+    # Joining the lines also keeps sheet data from injecting extra headers.
+    value = " ".join(str(value).splitlines())
+    if value.isascii():
+        return value
+    return Header(value, "utf-8").encode(linesep="\r\n")
+
+def address_value(value):
+    """Returns an address header value with only the display names RFC 2047-encoded."""
+    addresses = []
+    for name, address in getaddresses([" ".join(str(value).splitlines())]):
+        local, at, domain = address.rpartition("@")
+        if at and not domain.isascii():
+            address = f"{local}@{domain.encode('idna').decode('ascii')}"
+        if address.isascii():
+            addresses.append(formataddr((name, address), charset="utf-8"))
+        else:
+            # A non-ASCII local part can only go out as raw UTF-8 (RFC 6532).
+            addresses.append(f"{header_value(name)} <{address}>" if name else address)
+    return ", ".join(addresses)
+
+def new_message_id(sender):
+    """Returns a fresh RFC 5322 Message-ID on the sender address's domain."""
+    # Passing the domain also keeps make_msgid() from resolving the host name, which
+    # is meaningless (often "localhost") inside a container.
+    return make_msgid(domain=sender.rpartition("@")[2])
+
+def reply_subject(subject):
+    """Prefixes a subject with 'Re: ' unless it already has one."""
+    return f"Re: {subject}" if not subject.lower().startswith("re:") else subject
+
+def build_message(to_email, subject, html_body, *, thread_id=None, in_reply_to=None, message_id=None):
+    """Builds the Gmail messages.send body for an HTML email.
+
+    Pass thread_id and in_reply_to to send the email as a reply within an existing thread,
+    and message_id to set the Message-ID header instead of leaving it to Gmail.
+    The message is assembled directly rather than through EmailMessage, which
+    re-parses and validates every header on each of the campaign's messages.
+    """
+    headers = [
+        f"To: {address_value(to_email)}",
+        "From: me",
+        f"Subject: {header_value(subject)}",
+        # Gmail adds a Date on send, but messages.insert uses this one as the internal date.
+        f"Date: {formatdate(localtime=True)}",
+    ]
+    if message_id:
+        headers.append(f"Message-ID: {header_value(message_id)}")
+    if in_reply_to:
+        in_reply_to = header_value(in_reply_to)
+        headers += [f"In-Reply-To: {in_reply_to}", f"References: {in_reply_to}"]
+    raw = b"".join([
+        "\r\n".join(headers).encode("utf-8"),
+        b"\r\n",
+        _HTML_PART_HEADERS,
+        b"\r\n",
+        base64.encodebytes(html_body.encode("utf-8")).replace(b"\n", b"\r\n"),
+    ])
+    body = {"raw": encode_message(raw)}
+    if thread_id:
+        body["threadId"] = thread_id
+    return body
+
+# Upper bound on in-flight requests when falling back from batching to threads.
+MAX_CONCURRENT_REQUESTS = 10
+# Requests started per second by the thread-pool fallback, so it doesn't burst into 429s.
+# Reads such as messages.get are cheap. messages.send costs 100 of the 250 quota units
+# each user gets per second, so sends are paced separately.
+MAX_REQUESTS_PER_SECOND = 14
+SEND_REQUESTS_PER_SECOND = 2
+_thread_local = threading.local()
+
+class RateLimiter:
+    """Spaces out acquire() calls across threads to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(self._next_slot, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+# Give up on the rest of a run when Gmail keeps failing: BREAKER_THRESHOLD failed batch
+# calls within BREAKER_WINDOW seconds is one trip, and BREAKER_MAX_TRIPS trips with no
+# successful call in between open the breaker.
+BREAKER_THRESHOLD = 5
+BREAKER_WINDOW = 60
+BREAKER_MAX_TRIPS = 3
+
+class CircuitOpenError(Exception):
+    """Reported for requests that were not attempted because Gmail kept failing."""
+
+class UnknownOutcomeError(Exception):
+    """Reported for requests whose batch call lost its connection, so they may or may not have run."""
+
+class CircuitBreaker:
+    """Counts failed calls and opens after `max_trips` bursts of them with no success in between."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, window=BREAKER_WINDOW, max_trips=BREAKER_MAX_TRIPS):
+        self.window = window
+        self.max_trips = max_trips
+        self.trips = 0
+        self._failures = deque(maxlen=threshold)
+
+    @property
+    def is_open(self):
+        return self.trips >= self.max_trips
+
+    def record_failure(self):
+        failures = self._failures
+        failures.append(time.monotonic())
+        if len(failures) == failures.maxlen and failures[-1] - failures[0] < self.window:
+            self.trips += 1
+            failures.clear()
+
+    def record_success(self):
+        self.trips = 0
+        self._failures.clear()
+
+def _thread_http(credentials):
+    """Returns an authorized Http owned by the current thread (httplib2 is not thread-safe)."""
+    if getattr(_thread_local, "http", None) is None:
+        _thread_local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+    return _thread_local.http
+
+def execute_concurrently(requests, callback, rate=MAX_REQUESTS_PER_SECOND):
+    """Executes (request_id, request) pairs on a bounded thread pool.
+
+    Each worker uses its own Http object, and requests start at no more than `rate`
+    per second. The callback runs on the calling thread with
+    (request_id, response, exception), in completion order.
+    """
+    if not requests:
+        return
+    credentials = requests[0][1].http.credentials
+    # Refresh once up front rather than letting every worker race to refresh an expired token.
+    try:
+        refresh_if_expiring(credentials)
+    except Exception as e:
+        for request_id, _ in requests:
+            callback(request_id, None, e)
+        return
+    limiter = RateLimiter(rate)
+
+    def run(request):
+        limiter.acquire()
+        return retry_execute(request, http=_thread_http(credentials))
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        futures = {executor.submit(run, request): request_id for request_id, request in requests}
+        for future in as_completed(futures):
+            try:
+                response, exception = future.result(), None
+            except Exception as e:
+                response, exception = None, e
+            callback(futures[future], response, exception)
+
+def _run_batch(service, chunk, final_try):
+    """Runs one batch call.
+
+    Returns the (request_id, response, exception) results to report and the parts
+    that failed with a retryable error. Results are collected rather than reported
+    from inside batch.execute(), so anything it raises is a failure of the call itself.
+    """
+    requests_by_id = dict(chunk)
+    results = []
+    retry = []
+
+    def on_response(request_id, response, exception):
+        if not final_try and is_retryable(exception):
+            retry.append((request_id, requests_by_id[request_id], exception))
+        else:
+            results.append((request_id, response, exception))
+
+    batch = service.new_batch_http_request(callback=on_response)
+    for request_id, request in chunk:
+        batch.add(request, request_id=request_id)
+    batch.execute()
+    return results, retry
+
+def execute_batched(service, requests, callback, max_tries=MAX_TRIES, rate=MAX_REQUESTS_PER_SECOND, idempotent=False):
+    """Executes (request_id, request) pairs in Gmail batches, calling callback(request_id, response, exception) once for each.
+
+    Retries share one backoff budget for the whole run. Connection errors are retried only when `idempotent` is set.
+    """
+    if requests:
+        try:
+            refresh_if_expiring(requests[0][1].http.credentials)
+        except Exception as e:
+            for request_id, _ in requests:
+                callback(request_id, None, e)
+            return
+    breaker = CircuitBreaker()
+    last_error = None
+    batch_size = GMAIL_BATCH_SIZE
+    retries_left = max_tries - 1
+    start = 0
+    while start < len(requests):
+        chunk = requests[start:start + batch_size]
+        start += len(chunk)
+        retried = partly_throttled = False
+        while True:
+            if breaker.is_open:
+                # Gmail keeps failing: report the rest without calling it again.
+                skipped = CircuitOpenError(f"Not sent: Gmail kept failing ({last_error})")
+                for request_id, _ in chunk + requests[start:]:
+                    callback(request_id, None, skipped)
+                return
+            # The backoff keeps growing across chunks for as long as nothing gets through.
+            attempt = max_tries - 1 - retries_left
+            try:
+                results, failed = _run_batch(service, chunk, final_try=retries_left == 0)
+            except Exception as e:
+                if isinstance(e, TRANSPORT_ERRORS) and not idempotent:
+                    # The reply was lost, not necessarily the request: resending could
+                    # deliver the same emails twice.
+                    last_error = e
+                    breaker.record_failure()
+                    unknown = UnknownOutcomeError(f"Outcome unknown, check Sent mail before resending: the connection failed ({e})")
+                    for request_id, _ in chunk:
+                        callback(request_id, None, unknown)
+                    break
+                transient = is_retryable(e) or isinstance(e, TRANSPORT_ERRORS)
+                # The batch request failed as a whole, so none of its parts were processed.
+                if isinstance(e, HttpError) and e.resp.status in BATCH_UNAVAILABLE_STATUSES:
+                    execute_concurrently(chunk, callback, rate=rate)
+                    break
+                last_error = e
+                breaker.record_failure()
+                if transient and retries_left:
+                    retried = True
+                    retries_left -= 1
+                    time.sleep(backoff_delay(attempt, e))
+                    continue
+                # Out of retries, or an error (such as a 401) that every part would
+                # hit again: re-running the parts one by one would only add load.
+                for request_id, _ in chunk:
+                    callback(request_id, None, e)
+                break
+            succeeded = 0
+            for request_id, response, exception in results:
+                succeeded += exception is None
+                callback(request_id, response, exception)
+            retryable_errors = [error for _, _, error in failed] + [e for _, _, e in results if is_retryable(e)]
+            if succeeded:
+                # Anything getting through refills the retry budget.
+                retries_left = max_tries - 1
+                breaker.record_success()
+            elif retryable_errors:
+                # Nothing got through on this call.
+                last_error = retryable_errors[-1]
+                breaker.record_failure()
+            if not failed:
+                break
+            retried = True
+            if len(failed) < len(chunk) and any(is_rate_limited(error) for _, _, error in failed):
+                partly_throttled = True
+            retries_left -= 1
+            chunk = [(request_id, request) for request_id, request, _ in failed]
+            time.sleep(max(backoff_delay(attempt, error) for _, _, error in failed))
+        # AIMD: halve after a partly rate-limited batch, grow back after a clean one. A batch
+        # that failed entirely keeps its size, because shrinking it would only add calls.
+        if partly_throttled:
+            batch_size = max(MIN_BATCH_SIZE, batch_size // 2)
+        elif not retried:
+            batch_size = min(GMAIL_BATCH_SIZE, batch_size + BATCH_SIZE_STEP)
+
+# Waits between Message-ID lookup rounds double from 0.5s, up to 8s each and 30s in total.
+MESSAGE_ID_MAX_WAIT = 8
+MESSAGE_ID_TOTAL_WAIT = 30
+
+def fetch_message_ids(service, gmail_message_ids, total_wait=MESSAGE_ID_TOTAL_WAIT):
+    """Fetches the Message-ID header of sent messages with batched metadata requests.
+
+    The first round runs immediately. Messages Gmail has not finished processing are
+    retried together with doubling waits for up to `total_wait` seconds. Returns a dict
+    of Gmail message id -> Message-ID.
+    """
+    message_ids = {}
+
+    def on_fetched(request_id, response, exception):
+        if exception is None:
+            headers = response.get('payload', {}).get('headers', [])
+            message_id = next((h['value'] for h in headers if h['name'].lower() == 'message-id'), None)
+            if message_id:
+                message_ids[request_id] = message_id
+
+    missing = list(gmail_message_ids)
+    waited = 0
+    attempt = 0
+    while True:
+        get_requests = [
+            (gmail_id, service.users().messages().get(userId='me', id=gmail_id, format='metadata', metadataHeaders=['Message-ID']))
+            for gmail_id in missing
+        ]
+        execute_batched(service, get_requests, on_fetched, idempotent=True)
+        missing = [gmail_id for gmail_id in missing if gmail_id not in message_ids]
+        wait = min(MESSAGE_ID_MAX_WAIT, 0.5 * 2 ** attempt, total_wait - waited)
+        if not missing or wait <= 0:
+            break
+        time.sleep(wait)
+        waited += wait
+        attempt += 1
+    return message_ids
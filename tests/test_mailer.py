@@ -0,0 +1,196 @@
+import base64
+import json
+import socket
+from collections import Counter
+from datetime import datetime
+from email import message_from_bytes, policy
+from types import SimpleNamespace
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import mailer
+from mailer import address_value, build_message
+
+
+def parse(body):
+    """Decodes a messages.send body back into an EmailMessage."""
+    return message_from_bytes(base64.urlsafe_b64decode(body["raw"]), policy=policy.default)
+
+
+def test_non_ascii_display_name_keeps_address_parseable():
+    message = parse(build_message("José <jose@example.com>", "Hello", "<p>Hi</p>"))
+    [address] = message["To"].addresses
+    assert address.display_name == "José"
+    assert address.addr_spec == "jose@example.com"
+
+
+def test_idn_domain_is_punycoded():
+    assert address_value("jose@bücher.example") == "jose@xn--bcher-kva.example"
+
+
+def test_plain_and_multiple_addresses_pass_through():
+    assert address_value("a@example.com") == "a@example.com"
+    assert address_value('"Doe, Jane" <j@example.org>, k@example.org') == '"Doe, Jane" <j@example.org>, k@example.org'
+
+
+# --- execute_batched / fetch_message_ids, against a fake batch service ---
+def http_error(status, reason=None):
+    content = json.dumps({"error": {"errors": [{"reason": reason}]}}).encode() if reason else b""
+    return HttpError(httplib2.Response({"status": status}), content)
+
+
+class FakeRequest:
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.http = SimpleNamespace(credentials=SimpleNamespace(token="token", expiry=datetime(2999, 1, 1)))
+
+
+class FakeService:
+    """Answers each batch part with respond(request_id, attempt): a response dict or an exception."""
+
+    def __init__(self, respond, batch_errors=()):
+        self.respond = respond
+        self.batch_errors = list(batch_errors)
+        self.batch_sizes = []
+        self.attempts = Counter()
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, format, metadataHeaders):
+        return FakeRequest(id)
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.parts = []
+
+    def add(self, request, request_id):
+        self.parts.append(request_id)
+
+    def execute(self):
+        self.service.batch_sizes.append(len(self.parts))
+        if self.service.batch_errors:
+            raise self.service.batch_errors.pop(0)
+        for request_id in self.parts:
+            result = self.service.respond(request_id, self.service.attempts[request_id])
+            self.service.attempts[request_id] += 1
+            if isinstance(result, Exception):
+                self.callback(request_id, None, result)
+            else:
+                self.callback(request_id, result, None)
+
+
+@pytest.fixture(autouse=True)
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(mailer.time, "sleep", slept.append)
+    return slept
+
+
+def run(service, count, **kwargs):
+    results = []
+    requests = [(str(i), FakeRequest(str(i))) for i in range(count)]
+    mailer.execute_batched(service, requests, lambda *result: results.append(result), **kwargs)
+    return results
+
+
+def ok(request_id, attempt):
+    return {"id": request_id}
+
+
+def test_every_request_is_reported_exactly_once():
+    def respond(request_id, attempt):
+        if request_id == "3":
+            return http_error(400)
+        if int(request_id) % 7 == 0 and attempt == 0:
+            return http_error(503)
+        return ok(request_id, attempt)
+
+    results = run(FakeService(respond), 120)
+    assert sorted(request_id for request_id, _, _ in results) == sorted(str(i) for i in range(120))
+    errors = {request_id: exception for request_id, _, exception in results if exception is not None}
+    assert list(errors) == ["3"]
+
+
+def test_retry_budget_is_shared_across_chunks():
+    service = FakeService(lambda request_id, attempt: http_error(503))
+    results = run(service, 200)
+    # The first chunk uses the whole ladder; later chunks get a single try each.
+    assert service.batch_sizes == [50] * 6 + [50] * 3
+    assert all(exception.resp.status == 503 for _, _, exception in results)
+    assert len(results) == 200
+
+
+def test_breaker_fails_remaining_requests_without_calling_gmail():
+    service = FakeService(lambda request_id, attempt: http_error(503))
+    results = run(service, 1000)
+    assert len(service.batch_sizes) == 15
+    assert len(results) == 1000
+    skipped = [exception for _, _, exception in results if isinstance(exception, mailer.CircuitOpenError)]
+    assert len(skipped) == 1000 - 10 * 50
+
+
+def test_partial_rate_limiting_halves_then_regrows_the_batch():
+    def respond(request_id, attempt):
+        return http_error(429) if request_id == "0" and attempt == 0 else ok(request_id, attempt)
+
+    service = FakeService(respond)
+    run(service, 120)
+    assert service.batch_sizes[:4] == [50, 1, 25, 30]
+
+
+def test_fully_failed_batch_keeps_its_size():
+    service = FakeService(lambda request_id, attempt: http_error(503) if attempt == 0 else ok(request_id, attempt))
+    run(service, 150)
+    assert set(service.batch_sizes) == {50}
+
+
+def test_rate_limit_403_is_retried_and_other_403s_are_not():
+    def respond(request_id, attempt):
+        if attempt == 0 and request_id == "1":
+            return http_error(403, "userRateLimitExceeded")
+        if request_id == "2":
+            return http_error(403, "insufficientPermissions")
+        return ok(request_id, attempt)
+
+    service = FakeService(respond)
+    results = {request_id: exception for request_id, _, exception in run(service, 3)}
+    assert results["1"] is None
+    assert results["2"].resp.status == 403
+    assert service.attempts["2"] == 1
+
+
+def test_connection_error_is_not_resent_for_sends():
+    service = FakeService(ok, batch_errors=[socket.timeout("timed out")])
+    results = run(service, 50)
+    assert service.batch_sizes == [50]
+    assert all(isinstance(exception, mailer.UnknownOutcomeError) for _, _, exception in results)
+
+
+def test_connection_error_is_retried_for_reads():
+    service = FakeService(ok, batch_errors=[socket.timeout("timed out")])
+    results = run(service, 50, idempotent=True)
+    assert service.batch_sizes == [50, 50]
+    assert all(exception is None for _, _, exception in results)
+
+
+def test_fetch_message_ids_polls_for_up_to_30_seconds(sleeps):
+    def respond(gmail_id, attempt):
+        if gmail_id == "a" or (gmail_id == "b" and attempt >= 2):
+            return {"payload": {"headers": [{"name": "Message-ID", "value": f"<{gmail_id}@example.com>"}]}}
+        return {"payload": {"headers": []}}
+
+    message_ids = mailer.fetch_message_ids(FakeService(respond), ["a", "b", "c"])
+    assert message_ids == {"a": "<a@example.com>", "b": "<b@example.com>"}
+    assert sleeps == [0.5, 1, 2, 4, 8, 8, 6.5]